@@ -1,8 +1,9 @@
 import os
+import time
 import asyncio
 import sqlite3
-from dataclasses import dataclass
-from typing import List, Dict, Optional, Tuple, Any
+from dataclasses import dataclass, replace
+from typing import List, Dict, Optional, Tuple, Any, Set
 
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.filters import CommandStart, Command
@@ -41,6 +42,10 @@ if not BOT_TOKEN:
     raise SystemExit("Please set BOT_TOKEN in .env or environment")
 
 DB_PATH = os.getenv("DB_PATH", "stargifty.db")
+MARKET_LATENCY_BUDGET_SEC = float(os.getenv("MARKET_LATENCY_BUDGET_SEC", "3"))
+MARKET_OFFER_TTL_SEC = float(os.getenv("MARKET_OFFER_TTL_SEC", "60"))
+SNIPER_RANK = os.getenv("SNIPER_RANK", "price")  # price|discount
+SNIPER_MAX_SPEND_PER_TICK = int(os.getenv("SNIPER_MAX_SPEND_PER_TICK", "0"))  # 0 — без лимита
 STARS_CURRENCY = "XTR"
 BOT_BRAND = "StarGifty"
 
@@ -52,6 +57,7 @@ class MarketItem:
     title: str
     price_stars: int
     img: Optional[str] = None
+    venue: Optional[str] = None  # маркет, на котором найден лучший лот
 
 
 @dataclass
@@ -135,16 +141,15 @@ class DB:
                 (amount, user_id),
             )
 
-    def sub_balance(self, user_id: int, amount: int) -> bool:
+    def reserve_balance(self, user_id: int, amount: int) -> bool:
+        """Атомарно списать amount, если хватает баланса (одна транзакция)."""
         self.ensure_user(user_id)
-        if self.balance(user_id) < amount:
-            return False
         with self.conn:
-            self.conn.execute(
-                "UPDATE users SET balance_stars = balance_stars - ? WHERE user_id=?",
-                (amount, user_id),
+            cur = self.conn.execute(
+                "UPDATE users SET balance_stars = balance_stars - ? WHERE user_id=? AND balance_stars >= ?",
+                (amount, user_id, amount),
             )
-        return True
+        return cur.rowcount == 1
 
     # Subscriptions
     def add_sub(self, user_id: int, collection: str, max_price: int, recipient: str, card_msg: str) -> int:
@@ -224,6 +229,123 @@ class TelegramMarketClient:
         return True, f"tx-{item.item_id}"
 
 
+# --- Multi-market aggregation ---
+class MarketAggregator:
+    """Агрегатор нескольких маркетов в Telegram с тем же интерфейсом, что и
+    TelegramMarketClient.
+
+    • Поиск идёт параллельно по всем площадкам; каждой даётся свой бюджет
+      времени, медленная площадка просто выпадает из текущего скана.
+    • Лоты с одинаковым item_id склеиваются, наружу отдаётся самый дешёвый.
+    • buy_item идёт на самую дешёвую площадку, при неудаче — на следующую,
+      но не дороже max_price_stars. После покупки item.price_stars и
+      item.venue отражают фактическую сделку.
+    """
+
+    def __init__(self, venues: Dict[str, Any], latency_budget_sec: float = 3.0,
+                 budgets: Optional[Dict[str, float]] = None, offer_ttl_sec: float = 60.0):
+        if not venues:
+            raise ValueError("MarketAggregator needs at least one venue")
+        self.venues = venues
+        self.latency_budget_sec = latency_budget_sec
+        self.budgets = budgets or {}
+        self.offer_ttl_sec = offer_ttl_sec
+        # item_id -> (время скана, предложения площадок по возрастанию цены)
+        self._offers: Dict[str, Tuple[float, List[Tuple[str, MarketItem]]]] = {}
+
+    async def _ask(self, venue: str, call) -> List[MarketItem]:
+        budget = self.budgets.get(venue, self.latency_budget_sec)
+        try:
+            return await asyncio.wait_for(call(self.venues[venue]), timeout=budget)
+        except asyncio.TimeoutError:
+            print(f"Market {venue}: no answer within {budget}s, skipped")
+        except Exception as e:
+            print(f"Market {venue} error:", e)
+        return []
+
+    async def _fan_out(self, call) -> Tuple[List[MarketItem], Dict[str, List[Tuple[str, MarketItem]]]]:
+        names = list(self.venues)
+        results = await asyncio.gather(*(self._ask(n, call) for n in names))
+
+        offers: Dict[str, List[Tuple[str, MarketItem]]] = {}
+        for venue, items in zip(names, results):
+            for item in items:
+                offers.setdefault(item.item_id, []).append((venue, item))
+
+        merged = []
+        for lst in offers.values():
+            lst.sort(key=lambda o: o[1].price_stars)
+            venue, best = lst[0]
+            merged.append(MarketItem(
+                item_id=best.item_id,
+                collection=best.collection,
+                title=best.title,
+                price_stars=best.price_stars,
+                img=best.img,
+                venue=venue,
+            ))
+        merged.sort(key=lambda x: x.price_stars)
+        return merged, offers
+
+    def _remember(self, items: List[MarketItem], offers: Dict[str, List[Tuple[str, MarketItem]]]):
+        now = time.monotonic()
+        for item_id in [k for k, (ts, _) in self._offers.items() if now - ts > self.offer_ttl_sec]:
+            del self._offers[item_id]
+        for item in items:
+            self._offers[item.item_id] = (now, offers[item.item_id])
+
+    def _route(self, item: MarketItem, max_price_stars: int) -> List[Tuple[str, MarketItem]]:
+        entry = self._offers.get(item.item_id)
+        if entry and time.monotonic() - entry[0] <= self.offer_ttl_sec:
+            return [(v, it) for v, it in entry[1] if it.price_stars <= max_price_stars]
+        # Свежих предложений нет — только площадка, где лот видели, и только по его цене
+        if item.venue in self.venues and item.price_stars <= max_price_stars:
+            return [(item.venue, item)]
+        return []
+
+    def quote(self, item: MarketItem, max_price_stars: int) -> int:
+        """Сколько резервировать под покупку: худшая цена на маршруте."""
+        return max((it.price_stars for _, it in self._route(item, max_price_stars)), default=item.price_stars)
+
+    async def search_current_listings(self, collection: str, limit: int = 10) -> List[MarketItem]:
+        items, offers = await self._fan_out(lambda m: m.search_current_listings(collection, limit=limit))
+        items = items[:limit]
+        self._remember(items, offers)
+        return items
+
+    async def search_new_listings(self, collection: str, max_price_stars: int) -> List[MarketItem]:
+        items, offers = await self._fan_out(lambda m: m.search_new_listings(collection, max_price_stars))
+        items = [x for x in items if x.price_stars <= max_price_stars]
+        self._remember(items, offers)
+        return items
+
+    async def buy_item(self, item: MarketItem, max_price_stars: Optional[int] = None):
+        route = self._route(item, item.price_stars if max_price_stars is None else max_price_stars)
+        # Лот либо купим, либо предложения уже неактуальны
+        self._offers.pop(item.item_id, None)
+
+        for venue, venue_item in route:
+            try:
+                ok, deal_id = await self.venues[venue].buy_item(venue_item)
+            except Exception as e:
+                print(f"Market {venue} buy error:", e)
+                continue
+            if ok:
+                item.price_stars = venue_item.price_stars
+                item.venue = venue
+                return True, deal_id
+        return False, None
+
+    async def transfer_nft(self, item: MarketItem, recipient: str, card_msg: str):
+        if item.venue not in self.venues:
+            return False, None
+        try:
+            return await self.venues[item.venue].transfer_nft(item, recipient, card_msg)
+        except Exception as e:
+            print(f"Market {item.venue} transfer error:", e)
+            return False, None
+
+
 # --- Utilities ---
 def kb_builder(pairs: List[Tuple[str, str]], cols: int = 1):
     kb = InlineKeyboardBuilder()
@@ -240,7 +362,11 @@ def stars_prices(amount_stars: int) -> List[LabeledPrice]:
 # --- Bot setup ---
 router = Router()
 db = DB(DB_PATH)
-market = TelegramMarketClient()
+market = MarketAggregator(
+    {"tg": TelegramMarketClient()},
+    latency_budget_sec=MARKET_LATENCY_BUDGET_SEC,
+    offer_ttl_sec=MARKET_OFFER_TTL_SEC,
+)
 
 
 # --- FSMs ---
@@ -396,7 +522,7 @@ async def manual_show_item(call: CallbackQuery, state: FSMContext):
         f"<b>{item.title}</b>\\nКоллекция: <code>{item.collection}</code>\\nЦена: <b>{item.price_stars}⭐️</b>"
     )
     kb = InlineKeyboardBuilder()
-    kb.button(text="Выбрать получателя", callback_data=f"manual:pick:{item.item_id}:{item.price_stars}")
+    kb.button(text="Выбрать получателя", callback_data=f"manual:pick:{item.item_id}:{item.price_stars}:{item.venue or ''}")
     if len(ids) > 1:
         kb.button(text="◀️ Пред.", callback_data=f"manual:list:{(idx-1)%len(ids)}:{','.join(ids)}")
         kb.button(text="След. ▶️", callback_data=f"manual:list:{(idx+1)%len(ids)}:{','.join(ids)}")
@@ -408,8 +534,10 @@ async def manual_show_item(call: CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data.startswith("manual:pick:"))
 async def manual_pick_recipient(call: CallbackQuery, state: FSMContext):
-    _, _, item_id, price = call.data.split(":")
-    await state.update_data(item_id=item_id, price=int(price))
+    parts = call.data.split(":")  # manual:pick:item_id:price[:venue]
+    item_id, price = parts[2], parts[3]
+    venue = parts[4] if len(parts) > 4 else ""
+    await state.update_data(item_id=item_id, price=int(price), venue=venue)
     await state.set_state(ManualBuy.set_recipient)
     await call.message.edit_text(
         "Введи @username получателя или TON-адрес в ответ на это сообщение",
@@ -444,7 +572,7 @@ async def manual_set_card(message: Message, state: FSMContext):
         chat_id=message.chat.id,
         title=f"Покупка NFT — {BOT_BRAND}",
         description=f"Лот {item_id}. После оплаты купим на маркете и передадим получателю.",
-        payload=f"manual:{item_id}:{price}:{message.from_user.id}:{card}:{data['recipient']}",
+        payload=f"manualv:{item_id}:{price}:{message.from_user.id}:{data.get('venue', '')}:{card}:{data['recipient']}",
         provider_token="",
         currency=STARS_CURRENCY,
         prices=stars_prices(price),
@@ -511,6 +639,21 @@ async def sub_card(message: Message, state: FSMContext):
 
 
 # --- Payments ---
+def parse_manual_payload(payload: str) -> Tuple[str, int, int, Optional[str], str, str]:
+    """Разобрать payload ручной покупки.
+
+    manualv:item_id:price:user_id:venue:card:recipient — текущий формат;
+    manual:item_id:price:user_id:card:recipient — счета, выставленные до
+    мульти-маркета (площадка неизвестна, покупка идёт по кешу предложений).
+    """
+    if payload.startswith("manualv:"):
+        _, item_id, price, uid, venue, card_msg, recipient = payload.split(":", 6)
+    else:
+        _, item_id, price, uid, card_msg, recipient = payload.split(":", 5)
+        venue = ""
+    return item_id, int(price), int(uid), venue or None, card_msg, recipient
+
+
 @router.pre_checkout_query()
 async def pre_checkout(pre: PreCheckoutQuery):
     await pre.answer(ok=True)
@@ -527,11 +670,8 @@ async def on_successful_payment(message: Message):
         await message.answer(f"💰 Зачислено: {amount}⭐️. Баланс: {db.balance(message.from_user.id)}⭐️")
         return
 
-    if payload.startswith("manual:" ):
-        # payload: manual:item_id:price:user_id:card:recipient
-        _, item_id, price, uid, card_msg, recipient = payload.split(":", 5)
-        price = int(price)
-        user_id = int(uid)
+    if payload.startswith(("manual:", "manualv:")):
+        item_id, price, user_id, venue, card_msg, recipient = parse_manual_payload(payload)
 
         # Безопасность: убедимся, что оплачивал тот же пользователь
         if user_id != message.from_user.id:
@@ -540,7 +680,7 @@ async def on_successful_payment(message: Message):
 
         # Пытаемся купить и передать NFT
         collection = item_id.split("-#")[0]
-        itm = MarketItem(item_id=item_id, collection=collection, title=item_id, price_stars=price)
+        itm = MarketItem(item_id=item_id, collection=collection, title=item_id, price_stars=price, venue=venue)
         order_id = db.create_order(GiftOrder(
             id=None,
             user_id=user_id,
@@ -560,6 +700,10 @@ async def on_successful_payment(message: Message):
                 "❌ Не удалось купить лот (возможно, уже выкупили). Сумма зачислена на ваш баланс."
             )
             return
+        if itm.price_stars < price:
+            # Нашлась площадка дешевле оплаченного — разницу на баланс
+            db.add_balance(user_id, price - itm.price_stars)
+            db.update_order(order_id, price_stars=itm.price_stars)
 
         ok2, tx = await market.transfer_nft(itm, recipient, card_msg)
         if ok2:
@@ -595,67 +739,205 @@ async def cmd_deposit(message: Message):
 
 # --- Background sniper worker ---
 SCAN_INTERVAL_SEC = 8
+# user_id -> (тип уведомления, sub_id, item_id), о которых уже сказали; живут, пока лот в выдаче
+sniper_notified: Dict[int, Set[Tuple[str, int, str]]] = {}
+
+@dataclass
+class PurchaseCandidate:
+    sub_id: int
+    user_id: int
+    max_price_stars: int
+    recipient: str
+    card_msg: str
+    item: MarketItem
+    reserve_stars: int  # худшая цена среди площадок, куда может уйти покупка
+
+
+# Меньше — лучше. price: сначала дешёвые; discount: сначала с наибольшей скидкой к лимиту подписки.
+CANDIDATE_RANKERS = {
+    "price": lambda c: c.item.price_stars,
+    "discount": lambda c: -(c.max_price_stars - c.item.price_stars) / max(c.max_price_stars, 1),
+}
+if SNIPER_RANK not in CANDIDATE_RANKERS:
+    raise SystemExit(f"SNIPER_RANK must be one of: {', '.join(CANDIDATE_RANKERS)}")
+
+
+def plan_purchases(
+    candidates: List[PurchaseCandidate],
+    balance: int,
+    max_spend: int = 0,
+    rank: str = "price",
+) -> Tuple[List[PurchaseCandidate], List[PurchaseCandidate], List[PurchaseCandidate]]:
+    """Выбрать лоты одного пользователя (по всем его подпискам) в пределах
+    баланса и лимита трат за тик.
+
+    Отбор идёт по цене лота, а резерв урезается до остатка бюджета (но не
+    ниже цены): fallback на дорогие площадки не должен мешать дешёвой покупке.
+    Возвращает (к покупке, не хватает баланса, дороже лимита за тик). Лоты,
+    которым не хватило остатка бюджета в этом тике, не попадают никуда —
+    их подберёт следующий скан.
+    """
+    key = CANDIDATE_RANKERS[rank]
+    budget = balance if max_spend <= 0 else min(balance, max_spend)
+    chosen, short, over_cap = [], [], []
+    seen = set()
+    for c in sorted(candidates, key=key):
+        # Один и тот же лот мог попасть под несколько подписок
+        if c.item.item_id in seen or c.item.price_stars > c.max_price_stars:
+            continue
+        price = c.item.price_stars
+        if price <= budget:
+            c.reserve_stars = max(price, min(c.reserve_stars, budget))
+            chosen.append(c)
+            budget -= c.reserve_stars
+        elif price > balance:
+            short.append(c)
+        elif max_spend > 0 and price > max_spend:
+            over_cap.append(c)
+        else:
+            continue
+        seen.add(c.item.item_id)
+    return chosen, short, over_cap
+
+
+async def deliver_purchase(bot: Bot, c: PurchaseCandidate):
+    item = c.item
+    # Заказ пишем до трансфера: лот уже куплен и оплачен
+    order_id = db.create_order(GiftOrder(
+        id=None,
+        user_id=c.user_id,
+        item_id=item.item_id,
+        collection=item.collection,
+        price_stars=item.price_stars,
+        recipient=c.recipient,
+        card_msg=c.card_msg,
+        status="bought",
+    ))
+    ok2, tx = await market.transfer_nft(item, c.recipient, c.card_msg)
+    if ok2:
+        db.update_order(order_id, status="sent", tx_id=tx)
+
+    try:
+        if ok2:
+            await bot.send_message(
+                c.user_id,
+                f"🎯 Автопокупка по подписке #{c.sub_id}: {item.title} за {item.price_stars}⭐️\\nПередан: {c.recipient}. Tx: {tx}"
+            )
+        else:
+            await bot.send_message(
+                c.user_id,
+                f"Купили {item.title} по подписке #{c.sub_id}, но не смогли передать автоматически. Заказ #{order_id}. Попробуем повтор позже."
+            )
+    except Exception:
+        pass
+
+
+async def execute_plan(bot: Bot, user_id: int, candidates: List[PurchaseCandidate]):
+    chosen, short, over_cap = plan_purchases(
+        candidates, db.balance(user_id), SNIPER_MAX_SPEND_PER_TICK, SNIPER_RANK
+    )
+
+    # Каждый лот упоминаем один раз, а не каждый тик, пока он висит в выдаче
+    prev = sniper_notified.get(user_id, set())
+    current = {("short", c.sub_id, c.item.item_id) for c in short}
+    current |= {("over_cap", c.sub_id, c.item.item_id) for c in over_cap}
+    sniper_notified[user_id] = current
+    short = [c for c in short if ("short", c.sub_id, c.item.item_id) not in prev]
+    over_cap = [c for c in over_cap if ("over_cap", c.sub_id, c.item.item_id) not in prev]
+
+    # Цена в тексте — та, что сравнивалась с балансом и лимитом
+    notices = []
+    if short:
+        titles = ", ".join(f"{c.item.title} ({c.item.price_stars}⭐️, подписка #{c.sub_id})" for c in short)
+        notices.append(f"Недостаточно ⭐️ для автопокупки: {titles}. Пополните баланс.")
+    if over_cap:
+        titles = ", ".join(f"{c.item.title} ({c.item.price_stars}⭐️, подписка #{c.sub_id})" for c in over_cap)
+        notices.append(f"Дороже лимита автопокупок за раз ({SNIPER_MAX_SPEND_PER_TICK}⭐️): {titles}.")
+    for text in notices:
+        try:
+            await bot.send_message(user_id, text)
+        except Exception:
+            pass
+
+    if not chosen:
+        return
+    total = sum(c.reserve_stars for c in chosen)
+    if not db.reserve_balance(user_id, total):
+        # Баланс изменился между планированием и резервом — попробуем в следующий тик
+        return
+
+    results = await asyncio.gather(
+        *(market.buy_item(c.item, max_price_stars=c.reserve_stars) for c in chosen),
+        return_exceptions=True,
+    )
+    filled, refund = [], 0
+    for c, res in zip(chosen, results):
+        if isinstance(res, Exception) or not res[0]:
+            refund += c.reserve_stars
+        else:
+            # buy_item записал в item фактическую цену сделки
+            refund += c.reserve_stars - c.item.price_stars
+            filled.append(c)
+    if refund:
+        db.add_balance(user_id, refund)
+
+    results = await asyncio.gather(*(deliver_purchase(bot, c) for c in filled), return_exceptions=True)
+    for c, res in zip(filled, results):
+        if isinstance(res, Exception):
+            print(f"Sniper delivery error ({c.item.item_id}):", res)
+
 
 async def sniper_worker(dp: Dispatcher):
     await asyncio.sleep(2)
     bot = dp.bot
     while True:
         try:
-            for s in db.active_subs():
-                user_id = int(s["user_id"])
-                collection = s["collection"]
-                max_price = int(s["max_price_stars"])
-                recipient = s["recipient"]
-                card_msg = s["card_msg"]
-
-                items = await market.search_new_listings(collection, max_price)
-                if not items:
+            subs = db.active_subs()
+            # Один поиск на коллекцию (с самым высоким лимитом среди подписок), все — параллельно
+            limits: Dict[str, int] = {}
+            for s in subs:
+                limits[s["collection"]] = max(limits.get(s["collection"], 0), int(s["max_price_stars"]))
+            collections = list(limits)
+            found = await asyncio.gather(
+                *(market.search_new_listings(col, limits[col]) for col in collections),
+                return_exceptions=True,
+            )
+            listings: Dict[str, List[MarketItem]] = {}
+            for col, res in zip(collections, found):
+                if isinstance(res, Exception):
+                    print(f"Sniper search error ({col}):", res)
                     continue
+                listings[col] = res
 
-                bal = db.balance(user_id)
-                for item in items:
+            by_user: Dict[int, List[PurchaseCandidate]] = {}
+            for s in subs:
+                max_price = int(s["max_price_stars"])
+                for item in listings.get(s["collection"], []):
                     if item.price_stars > max_price:
                         continue
-                    if bal < item.price_stars:
-                        try:
-                            await bot.send_message(user_id, f"Недостаточно ⭐️ для автопокупки {item.title} ({item.price_stars}⭐️). Пополните баланс.")
-                        except Exception:
-                            pass
-                        continue
-
-                    if not db.sub_balance(user_id, item.price_stars):
-                        continue
-                    ok, deal_id = await market.buy_item(item)
-                    if not ok:
-                        db.add_balance(user_id, item.price_stars)
-                        continue
-
-                    ok2, tx = await market.transfer_nft(item, recipient, card_msg)
-                    order_id = db.create_order(GiftOrder(
-                        id=None,
-                        user_id=user_id,
-                        item_id=item.item_id,
-                        collection=item.collection,
-                        price_stars=item.price_stars,
-                        recipient=recipient,
-                        card_msg=card_msg,
-                        status="sent" if ok2 else "bought",
-                        tx_id=tx if ok2 else None,
+                    # Своя копия: buy_item пишет в лот фактическую сделку
+                    item = replace(item)
+                    by_user.setdefault(int(s["user_id"]), []).append(PurchaseCandidate(
+                        sub_id=int(s["id"]),
+                        user_id=int(s["user_id"]),
+                        max_price_stars=max_price,
+                        recipient=s["recipient"],
+                        card_msg=s["card_msg"],
+                        item=item,
+                        reserve_stars=market.quote(item, max_price),
                     ))
 
-                    try:
-                        if ok2:
-                            await bot.send_message(
-                                user_id,
-                                f"🎯 Автопокупка: {item.title} за {item.price_stars}⭐️\\nПередан: {recipient}. Tx: {tx}"
-                            )
-                        else:
-                            await bot.send_message(
-                                user_id,
-                                f"Купили {item.title}, но не смогли передать автоматически. Заказ #{order_id}. Попробуем повтор позже."
-                            )
-                    except Exception:
-                        pass
+            for user_id in set(sniper_notified) - set(by_user):
+                del sniper_notified[user_id]
+
+            users = list(by_user)
+            results = await asyncio.gather(
+                *(execute_plan(bot, user_id, by_user[user_id]) for user_id in users),
+                return_exceptions=True,
+            )
+            for user_id, res in zip(users, results):
+                if isinstance(res, Exception):
+                    print(f"Sniper error (user {user_id}):", res)
         except Exception as e:
             print("Sniper error:", e)
         await asyncio.sleep(SCAN_INTERVAL_SEC)
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+# bot.py читает окружение при импорте
+os.environ.setdefault("BOT_TOKEN", "123:test")
+os.environ["DB_PATH"] = ":memory:"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import MarketItem  # noqa: E402
+
+
+class FakeMarket:
+    """Локальная площадка: фиксированные цены, задержка и сбои по item_id."""
+
+    def __init__(self, prices=None, delay=0.0, fail_buy=(), fail_transfer=()):
+        self.prices = prices or {}
+        self.delay = delay
+        self.fail_buy = set(fail_buy)
+        self.fail_transfer = set(fail_transfer)
+        self.bought = []
+        self.transferred = []
+
+    async def search_current_listings(self, collection, limit=10):
+        await asyncio.sleep(self.delay)
+        items = [
+            MarketItem(item_id=item_id, collection=collection, title=item_id, price_stars=price)
+            for item_id, price in self.prices.items()
+        ]
+        return items[:limit]
+
+    async def search_new_listings(self, collection, max_price_stars):
+        items = await self.search_current_listings(collection)
+        return [x for x in items if x.price_stars <= max_price_stars]
+
+    async def buy_item(self, item):
+        self.bought.append((item.item_id, item.price_stars))
+        return item.item_id not in self.fail_buy, f"deal-{item.item_id}"
+
+    async def transfer_nft(self, item, recipient, card_msg):
+        if item.item_id in self.fail_transfer:
+            raise RuntimeError("transfer down")
+        self.transferred.append(item.item_id)
+        return True, f"tx-{item.item_id}"
+
+
+@pytest.fixture
+def fake_market():
+    return FakeMarket
@@ -0,0 +1,115 @@
+import asyncio
+
+from bot import MarketAggregator, MarketItem, parse_manual_payload
+
+
+class BrokenMarket:
+    """Адаптер без нужных методов — падает синхронно при вызове."""
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_slow_venue_is_dropped(fake_market):
+    fast = fake_market({"gift-#1": 100})
+    slow = fake_market({"gift-#1": 50, "gift-#2": 60}, delay=1.0)
+    agg = MarketAggregator({"fast": fast, "slow": slow}, latency_budget_sec=0.05)
+
+    items = run(agg.search_current_listings("gift"))
+
+    assert [(x.item_id, x.price_stars, x.venue) for x in items] == [("gift-#1", 100, "fast")]
+
+
+def test_broken_venue_does_not_kill_scan(fake_market):
+    agg = MarketAggregator({"ok": fake_market({"gift-#1": 100}), "broken": BrokenMarket()})
+
+    items = run(agg.search_new_listings("gift", 500))
+
+    assert [x.item_id for x in items] == ["gift-#1"]
+
+
+def test_duplicates_merged_at_cheapest_price(fake_market):
+    agg = MarketAggregator({
+        "a": fake_market({"gift-#1": 120, "gift-#2": 90}),
+        "b": fake_market({"gift-#1": 100}),
+    })
+
+    items = run(agg.search_current_listings("gift"))
+
+    assert [(x.item_id, x.price_stars, x.venue) for x in items] == [
+        ("gift-#2", 90, "a"),
+        ("gift-#1", 100, "b"),
+    ]
+
+
+def test_buy_falls_back_to_next_venue_and_transfers_there(fake_market):
+    a = fake_market({"gift-#1": 100}, fail_buy={"gift-#1"})
+    b = fake_market({"gift-#1": 110})
+    agg = MarketAggregator({"a": a, "b": b})
+
+    async def scenario():
+        item = (await agg.search_new_listings("gift", 200))[0]
+        assert agg.quote(item, 200) == 110
+        ok, deal = await agg.buy_item(item, max_price_stars=200)
+        sent = await agg.transfer_nft(item, "@friend", "card")
+        return item, ok, deal, sent
+
+    item, ok, deal, sent = run(scenario())
+
+    assert (ok, deal) == (True, "deal-gift-#1")
+    assert a.bought == [("gift-#1", 100)] and b.bought == [("gift-#1", 110)]
+    assert (item.price_stars, item.venue) == (110, "b")
+    assert sent == (True, "tx-gift-#1")
+    assert a.transferred == [] and b.transferred == ["gift-#1"]
+
+
+def test_buy_never_exceeds_max_price(fake_market):
+    a = fake_market({"gift-#1": 100}, fail_buy={"gift-#1"})
+    b = fake_market({"gift-#1": 110})
+    agg = MarketAggregator({"a": a, "b": b})
+
+    async def scenario():
+        item = (await agg.search_new_listings("gift", 200))[0]
+        return await agg.buy_item(item)
+
+    assert run(scenario()) == (False, None)
+    assert b.bought == []
+
+
+def test_stale_offers_only_go_to_known_venue(fake_market):
+    a = fake_market({"gift-#1": 100})
+    b = fake_market({"gift-#1": 100})
+    agg = MarketAggregator({"a": a, "b": b}, offer_ttl_sec=0)
+
+    assert run(agg.buy_item(MarketItem("gift-#1", "gift", "t", 100))) == (False, None)
+    assert run(agg.buy_item(MarketItem("gift-#1", "gift", "t", 100, venue="b")))[0]
+    assert a.bought == [] and b.bought == [("gift-#1", 100)]
+
+
+def test_expired_offers_are_not_used_for_fallback(fake_market):
+    a = fake_market({"gift-#1": 100}, fail_buy={"gift-#1"})
+    b = fake_market({"gift-#1": 110})
+    agg = MarketAggregator({"a": a, "b": b}, offer_ttl_sec=0)
+
+    item = run(agg.search_new_listings("gift", 200))[0]
+
+    # Кеш уже протух: только площадка из item.venue, без fallback на b
+    assert run(agg.buy_item(item, max_price_stars=200)) == (False, None)
+    assert a.bought == [("gift-#1", 100)] and b.bought == []
+
+
+def test_parse_manual_payload_current_format():
+    assert parse_manual_payload("manualv:gift-#1:100:42:tg:С днём рождения:@friend") == (
+        "gift-#1", 100, 42, "tg", "С днём рождения", "@friend",
+    )
+
+
+def test_parse_manual_payload_without_venue():
+    assert parse_manual_payload("manualv:gift-#1:100:42::С днём рождения:@friend")[3] is None
+
+
+def test_parse_manual_payload_legacy_format():
+    assert parse_manual_payload("manual:gift-#1:100:42:С днём рождения:@friend") == (
+        "gift-#1", 100, 42, None, "С днём рождения", "@friend",
+    )
@@ -0,0 +1,149 @@
+import asyncio
+
+import bot
+from bot import MarketAggregator, MarketItem, PurchaseCandidate, plan_purchases
+
+
+def cand(item_id, price, max_price=500, sub_id=1, user_id=1, reserve=None):
+    return PurchaseCandidate(
+        sub_id=sub_id,
+        user_id=user_id,
+        max_price_stars=max_price,
+        recipient="@friend",
+        card_msg="card",
+        item=MarketItem(item_id=item_id, collection="gift", title=item_id, price_stars=price, venue="tg"),
+        reserve_stars=price if reserve is None else reserve,
+    )
+
+
+def ids(cands):
+    return [c.item.item_id for c in cands]
+
+
+def test_plan_ranks_dedups_and_fits_budget():
+    chosen, short, over_cap = plan_purchases(
+        [cand("a", 120), cand("b", 100), cand("a", 120, sub_id=2), cand("c", 20), cand("d", 400)],
+        balance=300,
+        max_spend=250,
+    )
+
+    assert ids(chosen) == ["c", "b", "a"]
+    assert ids(short) == ["d"]
+    assert over_cap == []
+
+
+def test_plan_reports_items_over_tick_cap():
+    chosen, short, over_cap = plan_purchases([cand("a", 150)], balance=1000, max_spend=100)
+
+    assert (chosen, short, ids(over_cap)) == ([], [], ["a"])
+
+
+def test_plan_budgets_by_reserve():
+    chosen, short, _ = plan_purchases([cand("a", 100, reserve=150), cand("b", 100)], balance=200)
+
+    # a стоит 100, но резервирует 150 — на b остатка уже не хватает
+    assert ids(chosen) == ["a"]
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, user_id, text):
+        self.sent.append((user_id, text))
+
+
+def test_execute_plan_reserves_once_and_releases_unfilled(monkeypatch, fake_market):
+    venue = fake_market(fail_buy={"b"}, fail_transfer={"c"})
+    monkeypatch.setattr(bot, "market", MarketAggregator({"tg": venue}))
+    monkeypatch.setattr(bot, "SNIPER_MAX_SPEND_PER_TICK", 0)
+    user_id = 42
+    bot.db.add_balance(user_id, 300)
+
+    asyncio.run(bot.execute_plan(FakeBot(), user_id, [
+        cand("a", 120, user_id=user_id),
+        cand("b", 100, user_id=user_id),
+        cand("c", 50, user_id=user_id),
+    ]))
+
+    assert bot.db.balance(user_id) == 300 - 120 - 50
+    rows = bot.db.conn.execute(
+        "SELECT item_id, status FROM orders WHERE user_id=? ORDER BY item_id", (user_id,)
+    ).fetchall()
+    # Трансфер c упал, но заказ всё равно записан
+    assert [tuple(r) for r in rows] == [("a", "sent"), ("c", "bought")]
+
+
+def sniper_candidate(agg, user_id, max_price):
+    item = asyncio.run(agg.search_new_listings("gift", max_price))[0]
+    return PurchaseCandidate(
+        sub_id=1,
+        user_id=user_id,
+        max_price_stars=max_price,
+        recipient="@friend",
+        card_msg="card",
+        item=item,
+        reserve_stars=agg.quote(item, max_price),
+    )
+
+
+def test_expensive_fallback_does_not_block_cheap_fill(monkeypatch, fake_market):
+    a = fake_market({"gift-#1": 100})
+    b = fake_market({"gift-#1": 290})
+    agg = MarketAggregator({"a": a, "b": b})
+    monkeypatch.setattr(bot, "market", agg)
+    monkeypatch.setattr(bot, "SNIPER_MAX_SPEND_PER_TICK", 150)
+    user_id = 43
+    bot.db.add_balance(user_id, 150)
+
+    c = sniper_candidate(agg, user_id, 300)
+    assert c.reserve_stars == 290
+    chosen, short, over_cap = plan_purchases([c], balance=150, max_spend=150)
+    assert (ids(chosen), short, over_cap) == (["gift-#1"], [], [])
+    assert c.reserve_stars == 150
+
+    tg = FakeBot()
+    asyncio.run(bot.execute_plan(tg, user_id, [sniper_candidate(agg, user_id, 300)]))
+
+    assert a.bought == [("gift-#1", 100)] and b.bought == []
+    assert bot.db.balance(user_id) == 50
+    assert not any("Недостаточно" in text or "лимита" in text for _, text in tg.sent)
+
+
+def test_fallback_stays_within_reservation(monkeypatch, fake_market):
+    a = fake_market({"gift-#1": 100}, fail_buy={"gift-#1"})
+    b = fake_market({"gift-#1": 290})
+    agg = MarketAggregator({"a": a, "b": b})
+    monkeypatch.setattr(bot, "market", agg)
+    monkeypatch.setattr(bot, "SNIPER_MAX_SPEND_PER_TICK", 0)
+    user_id = 44
+    bot.db.add_balance(user_id, 150)
+
+    asyncio.run(bot.execute_plan(FakeBot(), user_id, [sniper_candidate(agg, user_id, 300)]))
+
+    # b дороже зарезервированных 150⭐️ — туда не идём, резерв возвращается
+    assert b.bought == []
+    assert bot.db.balance(user_id) == 150
+
+
+def test_notices_sent_once_per_listing(monkeypatch, fake_market):
+    monkeypatch.setattr(bot, "market", MarketAggregator({"tg": fake_market()}))
+    monkeypatch.setattr(bot, "SNIPER_MAX_SPEND_PER_TICK", 200)
+    user_id = 45
+    bot.db.add_balance(user_id, 250)
+    tg = FakeBot()
+
+    for _ in range(3):
+        asyncio.run(bot.execute_plan(tg, user_id, [
+            cand("big", 300, user_id=user_id),
+            cand("mid", 220, user_id=user_id, sub_id=2),
+        ]))
+
+    assert len(tg.sent) == 2
+    assert "big (300⭐️, подписка #1)" in tg.sent[0][1]
+    assert "mid (220⭐️, подписка #2)" in tg.sent[1][1]
+
+    # Лот пропал из выдачи и вернулся — снова предупреждаем
+    asyncio.run(bot.execute_plan(tg, user_id, []))
+    asyncio.run(bot.execute_plan(tg, user_id, [cand("big", 300, user_id=user_id)]))
+    assert len(tg.sent) == 3